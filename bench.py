@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+
+# The author disclaims copyright to this source code. Please see the
+# accompanying UNLICENSE file.
+
+"""
+Micro-benchmark of per-call overhead for uncontended try_consume().
+
+Each bucket type is timed against the raw cost of SQLite transactions on the
+same database: a bare BEGIN IMMEDIATE/COMMIT, and one with a single write.
+The difference is the overhead added by tbucket and apsw.
+
+Usage: python bench.py [--calls N] [--path PATH]
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import apsw
+
+import tbucket
+
+
+def timeit(func, calls):
+    """Returns the mean time of func(), in microseconds."""
+    func()
+    start = time.time()
+    for _ in range(calls):
+        func()
+    return (time.time() - start) / calls * 1e6
+
+
+def bench_raw(path, calls):
+    db = apsw.Connection(path)
+    db.setbusytimeout(5000)
+    cursor = db.cursor()
+    cursor.execute(
+        "create table if not exists bench (key text primary key, value float)")
+
+    def bare():
+        cursor.execute("begin immediate")
+        cursor.execute("commit")
+
+    def write():
+        cursor.execute("begin immediate")
+        cursor.execute(
+            "insert or replace into bench (key, value) values (?, ?)",
+            ("key", time.time()))
+        cursor.execute("commit")
+
+    yield "BEGIN IMMEDIATE/COMMIT", timeit(bare, calls)
+    yield "BEGIN IMMEDIATE/write/COMMIT", timeit(write, calls)
+    db.close()
+
+
+def bench_buckets(path, calls):
+    # Buckets big enough that no call fails.
+    buckets = (
+        ("TokenBucket", tbucket.TokenBucket(path, "tb", calls * 2, 1)),
+        ("ScheduledTokenBucket",
+         tbucket.ScheduledTokenBucket(path, "stb", calls * 2, 3600)),
+        ("GCRATokenBucket",
+         tbucket.GCRATokenBucket(path, "gcra", calls * 2, 1)),
+        ("SlidingWindowTokenBucket",
+         tbucket.SlidingWindowTokenBucket(path, "sw", calls * 2, 3600)),
+        ("TimeSeriesTokenBucket",
+         tbucket.TimeSeriesTokenBucket(path, "ts", calls * 2, 3600)),
+    )
+    for name, bucket in buckets:
+        yield name, timeit(lambda: bucket.try_consume(1), calls)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--calls", type=int, default=2000)
+    parser.add_argument(
+        "--path", help="Database to use. Defaults to a temporary file.")
+    args = parser.parse_args()
+
+    tmpdir = None
+    path = args.path
+    if path is None:
+        tmpdir = tempfile.mkdtemp()
+        path = os.path.join(tmpdir, "bench.db")
+    try:
+        tbucket.init_db(path)
+        print("SQLite %s, %d calls each" % (
+            apsw.sqlitelibversion(), args.calls))
+        for name, us in bench_raw(path, args.calls):
+            print("%-30s %10.1f us/call" % (name, us))
+        for name, us in bench_buckets(path, args.calls):
+            print("%-30s %10.1f us/call" % (name, us))
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+    main()
@@ -14,7 +14,8 @@ empty, we must wait for it to refill.
 These classes all use a SQLite database to store state. They take a "key"
 parameter which identifies the bucket within the database. This way, token
 bucket state may be shared between many different processes on a single
-machine.
+machine. The SharedMemory* variants instead keep state in a memory-mapped file,
+which is cheaper when the state never needs to leave one host.
 
 This library is tailored for the case of calling various APIs found in the wild
 which have low rate limits. Our goal is to closely model the algorithm behind
@@ -24,24 +25,48 @@ possible, without going over the limit.
 Note:
     This library treats SQLite's transaction semantics as a white box. In
     general, user-visible functions will initiate a BEGIN IMMEDIATE
-    transaction.
+    transaction. Where SQLite supports it, try_consume() on the classic and
+    scheduled buckets instead runs a single atomic statement in autocommit
+    mode.
 """
 
+import array
 import collections
 import contextlib
+import itertools
 import logging
+import math
 import os
 import random
+import struct
+import sys
 import threading
 import time
+import zlib
 
-import apsw
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 
 __all__ = [
     "TokenBucket",
     "ScheduledTokenBucket",
     "TimeSeriesTokenBucket",
+    "GCRATokenBucket",
+    "SlidingWindowTokenBucket",
+    "SharedMemoryTokenBucket",
+    "SharedMemoryScheduledTokenBucket",
+    "snapshot_shared_memory",
+    "UsageLog",
+    "init_db",
+    "recover_db",
+    "expire_idle",
+    "vacuum",
+    "maintain",
+    "rate_limited_map",
+    "CLOCK_TOLERANCE",
 ]
 
 
@@ -50,6 +75,219 @@ def log():
     return logging.getLogger(__name__)
 
 
+_TBF_SCHEMA_SQL = (
+    "create table if not exists tbf ("
+    "  key text primary key,"
+    "  tokens float not null,"
+    "  last float not null)")
+
+# Refills, checks and debits a bucket in a single statement. The "{available}"
+# placeholder is a SQL expression for the currently-available tokens, in terms
+# of the existing row. If the check fails, nothing is written and no row is
+# returned.
+_CONSUME_SQL_TEMPLATE = (
+    "insert into tbf (key, tokens, last) "
+    "select :key, :rate - :n, :now where :rate >= :n and :rate > :leave "
+    "on conflict (key) do update set "
+    "  tokens = {available} - :n, last = :now "
+    "where {available} >= :n and {available} > :leave "
+    "returning tokens, last")
+
+_have_returning_cache = None
+
+# Stored timestamps further than this many seconds in the future are assumed
+# to come from a clock which has since stepped backwards.
+CLOCK_TOLERANCE = 1.0
+
+
+
+def _recover_time_series(cursor, query_time, key=None):
+    """Shifts time-series keys which have timestamps in the future.
+
+    All of a key's timestamps are shifted by the same offset, so the latest
+    becomes `query_time` and their spacing is kept. The offsets are computed
+    before any timestamps are updated.
+
+    Args:
+        cursor: The cursor to use.
+        query_time: The current time.
+        key: Only repair this key. If None, repairs all keys.
+    """
+    sql = "select key, max(time) from ts_token_bucket"
+    params = ()
+    if key is not None:
+        sql += " where key = ?"
+        params = (key,)
+    sql += " group by key having max(time) > ?"
+    offsets = [
+        (query_time - latest, k) for k, latest in cursor.execute(
+            sql, params + (query_time + CLOCK_TOLERANCE,)).fetchall()]
+    cursor.executemany(
+        "update ts_token_bucket set time = time + ? where key = ?", offsets)
+
+
+def _wait(timeout, stop):
+    """Sleeps for a time, or until `stop` is set if it's not None."""
+    if stop is None:
+        time.sleep(timeout)
+    else:
+        stop.wait(timeout)
+
+
+class _ClockWatch(object):
+    """Detects backwards steps of the wall clock within this process.
+
+    This compares the wall clock with the monotonic clock. If the difference
+    between them shrinks by more than CLOCK_TOLERANCE, the wall clock must
+    have stepped backwards.
+
+    Attributes:
+        steps: The number of backwards steps detected so far.
+    """
+
+    def __init__(self):
+        self.steps = 0
+        self._monotonic = getattr(time, "monotonic", None)
+        self._offset = self._get_offset()
+
+    def _get_offset(self):
+        if self._monotonic is None:
+            return None
+        return time.time() - self._monotonic()
+
+    def check(self):
+        """Checks for a backwards step since the last check.
+
+        Returns:
+            The number of backwards steps detected so far.
+        """
+        offset = self._get_offset()
+        if offset is None:
+            return self.steps
+        if offset < self._offset - CLOCK_TOLERANCE:
+            log().warning(
+                "Wall clock stepped back by %ss", self._offset - offset)
+            self.steps += 1
+        self._offset = offset
+        return self.steps
+
+
+_clock_watch = _ClockWatch()
+
+
+def _ensure_schema(db, schema):
+    """Creates any missing tables and indexes.
+
+    This first checks sqlite_master for the schema objects, which only needs
+    a read lock. A write transaction is only started if some are missing.
+
+    Args:
+        db: An apsw.Connection.
+        schema: A sequence of (name, create_sql) pairs.
+    """
+    names = [name for name, _ in schema]
+    cursor = db.cursor()
+    existing = set(r[0] for r in cursor.execute(
+        "select name from sqlite_master where name in (%s)" %
+        ", ".join("?" * len(names)), names).fetchall())
+    missing = [sql for name, sql in schema if name not in existing]
+    if not missing:
+        return
+    # So vacuum() can work incrementally. This does nothing unless the
+    # database is still empty.
+    cursor.execute("pragma auto_vacuum = incremental")
+    with db:
+        for sql in missing:
+            cursor.execute(sql)
+
+
+class _Combiner(object):
+    """Combines concurrent calls from threads in one process into batches.
+
+    Each caller queues its arguments. One caller at a time is the leader. It
+    takes everything queued and serves it with a single call to the batch
+    function, then hands the results back to the waiting callers. Leadership
+    then passes to the first caller queued since the batch started, if any.
+
+    Attributes:
+        func: A function which takes a list of arguments and returns a list of
+            results, one for each.
+    """
+
+    def __init__(self, func):
+        self.func = func
+        self._lock = threading.Lock()
+        self._queue = []
+        self._leading = False
+
+    def submit(self, args):
+        """Queues arguments, and waits for their result.
+
+        Args:
+            args: The arguments for one call.
+
+        Returns:
+            The result for the given arguments. If the batch function raised
+                an exception, it's re-raised in every caller in the batch.
+        """
+        request = _CombinerRequest(args)
+        with self._lock:
+            self._queue.append(request)
+            lead = not self._leading
+            self._leading = True
+        if not lead:
+            request.event.wait()
+            if request.done:
+                return request.get()
+        with self._lock:
+            batch, self._queue = self._queue, []
+        try:
+            results = self.func([r.args for r in batch])
+        except:
+            error = sys.exc_info()[1]
+            for r in batch:
+                r.error = error
+        else:
+            for r, result in zip(batch, results):
+                r.result = result
+        with self._lock:
+            if self._queue:
+                self._queue[0].event.set()
+            else:
+                self._leading = False
+        for r in batch:
+            r.done = True
+            r.event.set()
+        return request.get()
+
+
+class _CombinerRequest(object):
+    """One call queued on a _Combiner."""
+
+    def __init__(self, args):
+        self.args = args
+        self.event = threading.Event()
+        self.done = False
+        self.result = None
+        self.error = None
+
+    def get(self):
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+def _have_returning():
+    """Returns whether SQLite supports UPSERT with RETURNING (3.35.0+)."""
+    global _have_returning_cache
+    if _have_returning_cache is None:
+        import apsw
+        version = tuple(
+            int(part) for part in apsw.sqlitelibversion().split("."))
+        _have_returning_cache = version >= (3, 35, 0)
+    return _have_returning_cache
+
+
 class TokenBucket(object):
     """
     A "classic" token bucket rate limiter.
@@ -68,50 +306,160 @@ class TokenBucket(object):
     stores one row per bucket, consisting of the most recent (tokens,
     timestamp) state tuple.
 
+    If `combine` is true, concurrent try_consume() and consume() calls on the
+    same instance from different threads get combined. One thread serves all
+    the queued calls in a single transaction, and hands back the results. This
+    greatly reduces lock contention when many threads share a bucket.
+
     Attributes:
         path: The path to the sqlite database.
         key: A unique key for this bucket within the database.
         rate: The maximum number of tokens.
         period: The time for the bucket to reach the maximum number of tokens.
             The bucket refills at a rate of `rate / period`.
+        usage: A UsageLog to record consumption to, or None.
     """
 
-    def __init__(self, path, key, rate, period):
+    # The available tokens as a SQL expression, for the single-statement
+    # consume. Subclasses which override _update() must override these to
+    # match, or set _CONSUME_SQL to None to always use a transaction.
+    _AVAILABLE_SQL = (
+        "max(0.0, min(:rate, "
+        "tokens + max(0.0, :now - last) * :rate / :period))")
+    _CONSUME_SQL = _CONSUME_SQL_TEMPLATE.format(available=_AVAILABLE_SQL)
+
+    # The (name, create_sql) pairs of the tables and indexes we use.
+    _SCHEMA = (("tbf", _TBF_SCHEMA_SQL),)
+
+    def __init__(self, path, key, rate, period, combine=False, usage=None):
         self.path = path
         self.key = key
         self.rate = float(rate)
         self.period = float(period)
+        self.usage = usage
 
         self._local = threading.local()
+        if combine:
+            self._combiner = _Combiner(self._try_consume_many)
+        else:
+            self._combiner = None
+        self._clock_steps = _clock_watch.steps
 
-    @property
-    def db(self):
-        """A thread-local apsw.Connection."""
-        db = getattr(self._local, "db", None)
-        if db is not None:
-            return db
+    def _connect(self):
+        """Opens a new thread-local connection.
+
+        The connection gets cached on the thread-local along with a single
+        cursor, which gets reused for all of our own queries. apsw caches
+        prepared statements per connection, keyed by SQL text, so reusing a
+        cursor with constant SQL avoids both creating new cursors and
+        re-preparing statements on each call.
+
+        The schema check is read-only if the schema already exists. See
+        `init_db()`.
+
+        Returns:
+            The cached apsw.Cursor for the new connection.
+        """
+        import apsw
         db = apsw.Connection(self.path)
         db.setbusytimeout(5000)
-        with db:
-            db.cursor().execute(
-                "create table if not exists tbf ("
-                "  key text primary key,"
-                "  tokens float not null,"
-                "  last float not null)")
+        _ensure_schema(db, self._SCHEMA)
         self._local.db = db
-        return db
+        self._local.cursor = db.cursor()
+        return self._local.cursor
+
+    @property
+    def db(self):
+        """A thread-local apsw.Connection."""
+        try:
+            return self._local.db
+        except AttributeError:
+            self._connect()
+            return self._local.db
+
+    @property
+    def _cursor(self):
+        """A cached apsw.Cursor for the thread-local connection."""
+        try:
+            return self._local.cursor
+        except AttributeError:
+            return self._connect()
 
     @contextlib.contextmanager
     def _begin(self):
-        """Returns a context manager for a BEGIN IMMEDIATE transaction."""
-        self.db.cursor().execute("begin immediate")
+        """Returns a context manager for a BEGIN IMMEDIATE transaction.
+
+        The context manager yields the cached cursor.
+        """
+        cursor = self._cursor
+        cursor.execute("begin immediate")
         try:
-            yield
+            yield cursor
         except:
-            self.db.cursor().execute("rollback")
+            cursor.execute("rollback")
             raise
         else:
-            self.db.cursor().execute("commit")
+            cursor.execute("commit")
+
+    def _clamp(self, tokens):
+        """Clamps a number of tokens to valid values."""
+        if tokens < 0:
+            return 0.0
+        if tokens > self.rate:
+            return self.rate
+        return tokens
+
+    def _read(self, cursor, query_time):
+        """Reads the bucket state, and updates it for a query time.
+
+        This function doesn't write to the database.
+
+        Args:
+            cursor: The cursor to use.
+            query_time: The query time.
+
+        Returns:
+            A (tokens, timestamp) tuple as of `query_time`, clamped to valid
+                values.
+        """
+        row = self._load(cursor)
+        if row is None:
+            tokens, timestamp = self.rate, query_time
+        else:
+            tokens, timestamp = row
+        tokens, _ = self._update(tokens, timestamp, query_time)
+        return (self._clamp(tokens), query_time)
+
+    def _load(self, cursor):
+        """Loads the stored bucket state.
+
+        Args:
+            cursor: The cursor to use.
+
+        Returns:
+            The stored (tokens, timestamp) tuple, or None if there is none.
+        """
+        # Always exhaust the cached cursor. A partially-read statement stays
+        # active and keeps holding its read lock.
+        rows = cursor.execute(
+            "select tokens, last from tbf where key = ?",
+            (self.key,)).fetchall()
+        if not rows:
+            return None
+        return rows[0]
+
+    def _write(self, cursor, tokens, timestamp):
+        """Writes the bucket state, without clamping it.
+
+        Args:
+            cursor: The cursor to use.
+            tokens: The number of tokens.
+            timestamp: The time at which we had this number of tokens.
+        """
+        cursor.execute(
+            "insert or replace into tbf (key, tokens, last) "
+            "values (?, ?, ?)",
+            (self.key, tokens, timestamp))
 
     def _set(self, tokens, timestamp=None):
         """Sets the state of the bucket.
@@ -131,14 +479,8 @@ class TokenBucket(object):
         with self.db:
             if timestamp is None:
                 timestamp = time.time()
-            if tokens < 0:
-                tokens = 0.0
-            if tokens > self.rate:
-                tokens = self.rate
-            self.db.cursor().execute(
-                "insert or replace into tbf (key, tokens, last) "
-                "values (?, ?, ?)",
-                (self.key, tokens, timestamp))
+            tokens = self._clamp(tokens)
+            self._write(self._cursor, tokens, timestamp)
             return (tokens, timestamp)
 
     def _update(self, tokens, timestamp, query_time):
@@ -154,7 +496,8 @@ class TokenBucket(object):
         Returns:
             A (tokens, timestamp) state tuple.
         """
-        tdelta = query_time - timestamp
+        # If the clock stepped backwards, don't drain tokens.
+        tdelta = max(0.0, query_time - timestamp)
         tokens += tdelta * self.rate / self.period
         return tokens, timestamp
 
@@ -167,16 +510,9 @@ class TokenBucket(object):
             A (tokens, timestamp) tuple, clamped to valid values.
         """
         with self.db:
-            row = self.db.cursor().execute(
-                "select tokens, last from tbf where key = ?",
-                (self.key,)).fetchone()
-            now = time.time()
-            if not row:
-                tokens, timestamp = self.rate, now
-            else:
-                tokens, timestamp = row
-            tokens, timestamp = self._update(tokens, timestamp, now)
-            tokens, timestamp = self._set(tokens, now)
+            cursor = self._cursor
+            tokens, timestamp = self._read(cursor, time.time())
+            self._write(cursor, tokens, timestamp)
             return (tokens, timestamp)
 
     def try_consume(self, n, leave=None):
@@ -185,8 +521,12 @@ class TokenBucket(object):
         If there are fewer tokens available than the number requested, this
         function will just signal failure, without waiting for a token.
 
-        This will perform a BEGIN IMMEDIATE transaction on the database while
-        querying and updating state.
+        If SQLite supports it (3.35.0+), this will perform a single
+        INSERT ... ON CONFLICT DO UPDATE ... RETURNING statement in autocommit
+        mode, which refills, checks and debits the bucket atomically. On
+        failure, nothing is written. Otherwise, or when several calls are
+        combined, this will perform a BEGIN IMMEDIATE transaction on the
+        database while querying and updating state.
 
         Args:
             n: The number of tokens to try to consume.
@@ -196,17 +536,128 @@ class TokenBucket(object):
         Returns:
             A (success, tokens, timestamp) tuple.
         """
+        result = self._try_consume(n, leave)
+        if self.usage is not None:
+            self.usage.record(self.key, n, result[0])
+        return result
+
+    def _try_consume(self, n, leave):
+        """Try to consume some tokens, without recording usage.
+
+        Args:
+            n: The number of tokens to try to consume.
+            leave: The number of tokens to leave over, or None.
+
+        Returns:
+            A result tuple, as for try_consume().
+        """
         if leave is None:
             leave = 0
-        with self._begin():
-            tokens, timestamp = self._peek()
-            if tokens >= n and tokens > leave:
-                tokens, timestamp = self._set(tokens - n, timestamp=timestamp)
-                log().debug(
-                    "%s: Gave %s token(s). %s remaining.",
-                    self.key, n, tokens)
-                return (True, tokens, timestamp)
-            return (False, tokens, timestamp)
+        steps = _clock_watch.check()
+        if steps != self._clock_steps:
+            self._clock_steps = steps
+            self.recover()
+        if self._combiner is not None:
+            return self._combiner.submit((n, leave))
+        return self._try_consume_many([(n, leave)])[0]
+
+    def _recover(self, cursor, query_time):
+        """Repairs state which is in the future, after the clock stepped back.
+
+        Args:
+            cursor: The cursor to use.
+            query_time: The current time.
+        """
+        cursor.execute(
+            "update tbf set last = ? where key = ? and last > ?",
+            (query_time, self.key, query_time + CLOCK_TOLERANCE))
+
+    def recover(self):
+        """Repairs state which is in the future, after the clock stepped back.
+
+        This gets called automatically when try_consume() or consume() notice
+        that the clock stepped backwards in this process. See also
+        `recover_db()`, for use at startup.
+
+        This will perform a BEGIN IMMEDIATE transaction on the database.
+        """
+        log().warning("%s: Repairing state after a clock step", self.key)
+        with self._begin() as cursor:
+            self._recover(cursor, time.time())
+
+    def _try_consume_many(self, requests):
+        """Try to consume tokens for several requests, in order.
+
+        A single request uses the single-statement consume, if supported.
+        Otherwise, all requests are served in one BEGIN IMMEDIATE transaction.
+
+        Args:
+            requests: A list of (n, leave) tuples, as for try_consume().
+
+        Returns:
+            A list of (success, tokens, timestamp) tuples, one per request.
+        """
+        if (len(requests) == 1 and self._CONSUME_SQL is not None and
+                _have_returning()):
+            return [self._try_consume_returning(*requests[0])]
+        results = []
+        with self._begin() as cursor:
+            tokens, timestamp = self._read(cursor, time.time())
+            for n, leave in requests:
+                success = tokens >= n and tokens > leave
+                if success:
+                    tokens -= n
+                    log().debug(
+                        "%s: Gave %s token(s). %s remaining.",
+                        self.key, n, tokens)
+                results.append((success, tokens, timestamp))
+            self._write(cursor, tokens, timestamp)
+        return results
+
+    def _consume_params(self, n, leave, query_time):
+        """Returns the bindings for _CONSUME_SQL.
+
+        Args:
+            n: The number of tokens to try to consume.
+            leave: The number of tokens to leave over.
+            query_time: The query time.
+
+        Returns:
+            A dict of named bindings.
+        """
+        return {
+            "key": self.key,
+            "n": n,
+            "leave": leave,
+            "rate": self.rate,
+            "period": self.period,
+            "now": query_time,
+        }
+
+    def _try_consume_returning(self, n, leave):
+        """Try to consume some tokens with a single statement.
+
+        This runs _CONSUME_SQL in autocommit mode. If it fails, the state is
+        read back without writing.
+
+        Args:
+            n: The number of tokens to try to consume.
+            leave: The number of tokens to leave over.
+
+        Returns:
+            A (success, tokens, timestamp) tuple.
+        """
+        cursor = self._cursor
+        now = time.time()
+        rows = cursor.execute(
+            self._CONSUME_SQL, self._consume_params(n, leave, now)).fetchall()
+        if rows:
+            tokens, timestamp = rows[0]
+            log().debug(
+                "%s: Gave %s token(s). %s remaining.", self.key, n, tokens)
+            return (True, tokens, timestamp)
+        tokens, timestamp = self._read(cursor, now)
+        return (False, tokens, timestamp)
 
     def _estimate(self, tokens, timestamp, n, query_time):
         """Estimate the timestamp at which we would have a number of tokens.
@@ -224,7 +675,7 @@ class TokenBucket(object):
         """
         return timestamp + (n - tokens) * self.period / self.rate
 
-    def consume(self, n, leave=None):
+    def consume(self, n, leave=None, stop=None):
         """Consume tokens, waiting for them if necessary.
 
         This will perform a BEGIN IMMEDIATE transaction on the database while
@@ -235,21 +686,96 @@ class TokenBucket(object):
             n: The number of tokens to consume.
             leave: A number of tokens. Only successfully consume tokens once we
                 would be able to leave this many behind.
+            stop: A threading.Event, or None. If it gets set while we're
+                waiting, we give up without consuming any tokens.
 
         Returns:
-            A (tokens, timestamp) tuple.
+            A (tokens, timestamp) tuple, or None if we gave up due to `stop`.
         """
         assert n > 0
-        while True:
-            success, tokens, timestamp = self.try_consume(n, leave=leave)
+        waited = 0.0
+        while stop is None or not stop.is_set():
+            success, tokens, timestamp = self._try_consume(n, leave)
             if success:
+                if self.usage is not None:
+                    self.usage.record(self.key, n, True, wait=waited)
                 return (tokens, timestamp)
             now = time.time()
             target = self._estimate(tokens, timestamp, n, now)
             if target > now:
                 wait = target - now
                 log().debug("%s: Waiting %ss for tokens", self.key, wait)
-                time.sleep(wait)
+                _wait(wait, stop)
+                waited += time.time() - now
+        return None
+
+    def _read_state(self, query_time):
+        """Reads the bucket state as of a query time, without writing.
+
+        This doesn't take a write lock.
+
+        Args:
+            query_time: The query time.
+
+        Returns:
+            A (tokens, timestamp) tuple, clamped to valid values.
+        """
+        return self._read(self._cursor, query_time)
+
+    def _schedule(self, tokens, timestamp, n_total, end, leave):
+        """Estimate when each of a number of tokens would become available.
+
+        This function doesn't touch the database, and has no side effects.
+
+        Args:
+            tokens: The last known number of tokens.
+            timestamp: The timestamp of the last known number of tokens.
+            n_total: The maximum number of tokens to schedule.
+            end: The latest timestamp to schedule.
+            leave: The number of tokens to leave over.
+
+        Returns:
+            An array.array("d") of non-decreasing timestamps.
+        """
+        schedule = array.array("d")
+        need = max(1.0, leave)
+        # As for try_consume(), we need tokens > leave, and tokens never
+        # exceed the rate.
+        if need > self.rate or (leave >= 1 and need >= self.rate):
+            return schedule
+        interval = self.period / self.rate
+        for i in range(int(n_total)):
+            t = timestamp + max(0.0, i + need - tokens) * interval
+            if t > end:
+                break
+            schedule.append(t)
+        return schedule
+
+    def availability_schedule(self, n_total, horizon, leave=None):
+        """Estimate when each of a number of tokens will become available.
+
+        This models consuming the tokens one at a time, each as soon as it
+        becomes available, with no other consumers. This is useful for
+        planning a batch of work in advance.
+
+        This performs a single read of the state, and doesn't write.
+
+        Args:
+            n_total: The maximum number of tokens to schedule.
+            horizon: Only schedule tokens which become available within this
+                many seconds from now.
+            leave: A number of tokens. Only schedule tokens which could be
+                consumed while leaving this many behind.
+
+        Returns:
+            An array.array("d") of up to `n_total` non-decreasing timestamps.
+                The i-th timestamp is when the i-th token becomes available.
+        """
+        if leave is None:
+            leave = 0
+        tokens, timestamp = self._read_state(time.time())
+        return self._schedule(
+            tokens, timestamp, n_total, timestamp + horizon, leave)
 
     def peek(self):
         """Peek at the current number of tokens, and update the state.
@@ -304,9 +830,14 @@ class ScheduledTokenBucket(TokenBucket):
         period: How often the bucket is reset.
     """
 
-    def __init__(self, path, key, rate, period):
+    _AVAILABLE_SQL = (
+        "case when :refill > last then :rate "
+        "else max(0.0, min(:rate, tokens)) end")
+    _CONSUME_SQL = _CONSUME_SQL_TEMPLATE.format(available=_AVAILABLE_SQL)
+
+    def __init__(self, path, key, rate, period, combine=False, usage=None):
         super(ScheduledTokenBucket, self).__init__(
-            path, key, rate, period)
+            path, key, rate, period, combine=combine, usage=usage)
 
     def _get_last_refill(self, when):
         """Get the last time the bucket refilled, as of a query time.
@@ -336,11 +867,50 @@ class ScheduledTokenBucket(TokenBucket):
             return (self.rate, last_refill)
         return (tokens, query_time)
 
+    def _consume_params(self, n, leave, query_time):
+        params = super(ScheduledTokenBucket, self)._consume_params(
+            n, leave, query_time)
+        params["refill"] = self._get_last_refill(query_time)
+        return params
+
     def _estimate(self, tokens, timestamp, n, query_time):
         if tokens >= n:
             return query_time
         return self._get_next_refill(query_time)
 
+    def _consumable(self, tokens, leave):
+        """Count how many single tokens can be consumed from a given number.
+
+        Each consume needs at least one token, and more than `leave`.
+
+        Args:
+            tokens: The number of tokens available.
+            leave: The number of tokens to leave over.
+
+        Returns:
+            The number of tokens which can be consumed one at a time.
+        """
+        # The i-th consume (from 0) needs tokens - i >= 1 and tokens - i >
+        # leave.
+        last = min(
+            math.floor(tokens - 1), math.ceil(tokens - leave) - 1)
+        return max(0, int(last) + 1)
+
+    def _schedule(self, tokens, timestamp, n_total, end, leave):
+        schedule = array.array("d")
+        # The number of tokens consumable now, and after each refill.
+        first = self._consumable(tokens, leave)
+        per_refill = self._consumable(self.rate, leave)
+        schedule.extend([timestamp] * min(first, int(n_total)))
+        if not per_refill:
+            return schedule
+        refill = self._get_next_refill(timestamp)
+        while len(schedule) < n_total and refill <= end:
+            count = min(per_refill, int(n_total) - len(schedule))
+            schedule.extend([refill] * count)
+            refill += self.period
+        return schedule
+
 
 class TimeSeriesTokenBucket(TokenBucket):
     """
@@ -368,43 +938,66 @@ class TimeSeriesTokenBucket(TokenBucket):
         period: How often the bucket is reset.
     """
 
-    def __init__(self, path, key, rate, period, trim_func=None):
-        super(TimeSeriesTokenBucket, self).__init__(path, key, rate, period)
+    _SCHEMA = (
+        ("ts_token_bucket",
+         "create table if not exists ts_token_bucket ("
+         "  key text not null,"
+         "  time float not null)"),
+        ("ts_token_bucket_key_time",
+         "create index if not exists ts_token_bucket_key_time "
+         "on ts_token_bucket (key, time)"),
+    )
+
+    def __init__(self, path, key, rate, period, trim_func=None,
+                 combine=False, usage=None):
+        super(TimeSeriesTokenBucket, self).__init__(
+            path, key, rate, period, combine=combine, usage=usage)
         self.rate = int(self.rate)
         if trim_func is None:
             trim_func = self._trim_default
         self.trim = trim_func
 
-    @property
-    def db(self):
-        """A thread-local apsw.Connection."""
-        db = getattr(self._local, "db", None)
-        if db is not None:
-            return db
-        db = apsw.Connection(self.path)
-        db.setbusytimeout(5000)
-        with db:
-            db.cursor().execute(
-                "create table if not exists ts_token_bucket ("
-                "  key text not null,"
-                "  time float not null)")
-            db.cursor().execute(
-                "create index if not exists ts_token_bucket_key_time "
-                "on ts_token_bucket (key, time)")
-        self._local.db = db
-        return db
-
     def _trim_default(self):
-        r = self.db.cursor().execute(
+        cursor = self._cursor
+        latest = cursor.execute(
             "select max(time) from ts_token_bucket where key = ?",
-            (self.key,)).fetchone()
-        if r is None or r[0] is None:
+            (self.key,)).fetchall()[0][0]
+        if latest is None:
             return
-        latest = r[0]
-        self.db.cursor().execute(
+        cursor.execute(
             "delete from ts_token_bucket where key = ? and time < ?",
             (self.key, latest - self.period))
 
+    def _select(self, cursor, query_time):
+        """Gets the token timestamps in the window ending at a query time.
+
+        This function doesn't write to the database.
+
+        Args:
+            cursor: The cursor to use.
+            query_time: The end of the window.
+
+        Returns:
+            A list of timestamps between `query_time - period` and
+                `query_time`.
+        """
+        cursor.execute(
+            "select time from ts_token_bucket "
+            "where key = ? and time >= ? and time <= ?",
+            (self.key, query_time - self.period, query_time))
+        return [r[0] for r in cursor.fetchall()]
+
+    def _insert(self, cursor, times):
+        """Inserts new token timestamps, without trimming.
+
+        Args:
+            cursor: The cursor to use.
+            times: A list of timestamps when some tokens were given out.
+        """
+        cursor.executemany(
+            "insert into ts_token_bucket (key, time) values (?, ?)",
+            [(self.key, t) for t in times])
+
     def _record(self, *times):
         """Record new token timestamps.
 
@@ -416,9 +1009,7 @@ class TimeSeriesTokenBucket(TokenBucket):
         if not times:
             return
         with self.db:
-            self.db.cursor().executemany(
-                "insert into ts_token_bucket (key, time) values (?, ?)",
-                [(self.key, t) for t in times])
+            self._insert(self._cursor, times)
             self.trim()
 
     def record(self, *times):
@@ -466,7 +1057,7 @@ class TimeSeriesTokenBucket(TokenBucket):
             if times_to_add :
                 self._record(*times_to_add)
             if times_to_delete:
-                self.db.cursor().executemany(
+                self._cursor.executemany(
                     "delete from ts_token_bucket where rowid = "
                     "(select rowid from ts_token_bucket "
                     "where key = ? and time = ? limit 1)",
@@ -590,12 +1181,7 @@ class TimeSeriesTokenBucket(TokenBucket):
         if query_time is None:
             query_time = time.time()
         with self.db:
-            c = self.db.cursor()
-            c.execute(
-                "select time from ts_token_bucket "
-                "where key = ? and time >= ? and time <= ?",
-                (self.key, query_time - self.period, query_time))
-            times = [r[0] for r in c.fetchall()]
+            times = self._select(self._cursor, query_time)
             return (self.rate - len(times), times, query_time)
 
     def try_consume(self, n, leave=None):
@@ -615,23 +1201,53 @@ class TimeSeriesTokenBucket(TokenBucket):
         Returns:
             A (success, tokens, list_of_timestamps, query_time) tuple.
         """
+        result = self._try_consume(n, leave)
+        if self.usage is not None:
+            self.usage.record(self.key, n, result[0])
+        return result
+
+    def _try_consume(self, n, leave):
         assert n > 0, n
         assert n <= self.rate, n
-        if leave is None:
-            leave = 0
-        success = False
-        with self._begin():
-            _, times, query_time = self.peek()
-            tokens = self.rate - len(times)
-            if tokens >= n and tokens > leave:
-                new_times = [query_time] * n
-                self._record(*new_times)
-                times += new_times
-                tokens -= n
-                log().debug(
-                    "%s: Gave %s token(s). %s remaining.", self.key, n, tokens)
-                success = True
-            return (success, self.rate - len(times), times, query_time)
+        return super(TimeSeriesTokenBucket, self)._try_consume(n, leave)
+
+    def _recover(self, cursor, query_time):
+        # Shift all our timestamps back so the latest is now, keeping their
+        # spacing. They get trimmed normally after that.
+        _recover_time_series(cursor, query_time, key=self.key)
+
+    def _try_consume_many(self, requests):
+        """Try to consume tokens for several requests, in order.
+
+        All requests are served in one BEGIN IMMEDIATE transaction.
+
+        Args:
+            requests: A list of (n, leave) tuples, as for try_consume().
+
+        Returns:
+            A list of (success, tokens, list_of_timestamps, query_time)
+                tuples, one per request.
+        """
+        results = []
+        with self._begin() as cursor:
+            query_time = time.time()
+            times = self._select(cursor, query_time)
+            new_times = []
+            for n, leave in requests:
+                tokens = self.rate - len(times)
+                success = tokens >= n and tokens > leave
+                if success:
+                    times = times + [query_time] * n
+                    new_times += [query_time] * n
+                    log().debug(
+                        "%s: Gave %s token(s). %s remaining.",
+                        self.key, n, tokens - n)
+                results.append(
+                    (success, self.rate - len(times), times, query_time))
+            if new_times:
+                self._insert(cursor, new_times)
+                self.trim()
+        return results
 
     def _estimate(self, times, query_time, n):
         """Estimate the timestamp at which we would have a number of tokens.
@@ -671,7 +1287,67 @@ class TimeSeriesTokenBucket(TokenBucket):
         _, times, query_time = self.peek(query_time=query_time)
         return self._estimate(times, query_time, n)
 
-    def consume(self, n, leave=None):
+    def _schedule(self, times, query_time, n_total, end, leave):
+        """Estimate when each of a number of tokens would become available.
+
+        This function doesn't touch the database, and has no side effects.
+
+        Args:
+            times: A list of token timestamps, between `query_time - period`
+                and `query_time`.
+            query_time: The time as of which the query is made.
+            n_total: The maximum number of tokens to schedule.
+            end: The latest timestamp to schedule.
+            leave: The number of tokens to leave over.
+
+        Returns:
+            An array.array("d") of non-decreasing timestamps.
+        """
+        schedule = array.array("d")
+        # The most token timestamps the window may hold before a consume.
+        most = self.rate - max(1, int(leave) + 1)
+        if most < 0:
+            return schedule
+        times = sorted(times)
+        for _ in range(int(n_total)):
+            if len(times) > most:
+                t = max(query_time, times[-(most + 1)] + self.period)
+            else:
+                t = query_time
+            if t > end:
+                break
+            schedule.append(t)
+            times.append(t)
+        return schedule
+
+    def availability_schedule(self, n_total, horizon, leave=None):
+        """Estimate when each of a number of tokens will become available.
+
+        This models consuming the tokens one at a time, each as soon as it
+        becomes available, with no other consumers. This is useful for
+        planning a batch of work in advance.
+
+        This will perform a SAVEPOINT/RELEASE on the database, and a single
+        read.
+
+        Args:
+            n_total: The maximum number of tokens to schedule.
+            horizon: Only schedule tokens which become available within this
+                many seconds from now.
+            leave: A number of tokens. Only schedule tokens which could be
+                consumed while leaving this many behind.
+
+        Returns:
+            An array.array("d") of up to `n_total` non-decreasing timestamps.
+                The i-th timestamp is when the i-th token becomes available.
+        """
+        if leave is None:
+            leave = 0
+        _, times, query_time = self.peek()
+        return self._schedule(
+            times, query_time, n_total, query_time + horizon, leave)
+
+    def consume(self, n, leave=None, stop=None):
         """Consume tokens, waiting for them if necessary.
 
         This will perform a BEGIN IMMEDIATE transaction on the database while
@@ -682,18 +1358,1198 @@ class TimeSeriesTokenBucket(TokenBucket):
             n: The number of tokens to consume.
             leave: A number of tokens. Only successfully consume tokens once we
                 would be able to leave this many behind.
+            stop: A threading.Event, or None. If it gets set while we're
+                waiting, we give up without consuming any tokens.
 
         Returns:
             A tuple of (tokens, list_of_timestamps, query_Time). The number of
-                tokens will always be `rate - len(list_of_timestamps`).
+                tokens will always be `rate - len(list_of_timestamps`). None if
+                we gave up due to `stop`.
         """
-        while True:
-            success, _, times, query_time = self.try_consume(n, leave=leave)
+        waited = 0.0
+        while stop is None or not stop.is_set():
+            success, _, times, query_time = self._try_consume(n, leave)
             if success:
+                if self.usage is not None:
+                    self.usage.record(self.key, n, True, wait=waited)
                 return (self.rate - len(times), times, query_time)
             target = self._estimate(times, query_time, n)
             now = time.time()
             if target > now:
                 wait = target - now
                 log().debug("%s: Waiting %ss for tokens", self.key, wait)
-                time.sleep(wait)
+                _wait(wait, stop)
+                waited += time.time() - now
+        return None
+
+
+class GCRATokenBucket(TokenBucket):
+    """
+    A classic token bucket, stored as a single "theoretical arrival time".
+
+    This implements the generic cell rate algorithm (GCRA). It has the same
+    semantics as TokenBucket, but stores one timestamp per key instead of a
+    (tokens, timestamp) pair: the time at which the bucket will be full. Each
+    token consumed pushes this "theoretical arrival time" (TAT) later by
+    `period / rate`.
+
+    The state of the bucket is still represented as a (tokens, timestamp)
+    tuple, and gets returned from most functions.
+
+    Compared to TimeSeriesTokenBucket, which gives out exactly `rate` tokens in
+    any window of length `period`, this (like TokenBucket) may give out up to
+    `2 * rate`: a full bucket, plus another `rate` as it refills. Its long-run
+    rate is the same.
+
+    Since the TAT is an absolute time, a backwards clock step reduces the
+    available tokens until the clock catches up. recover() limits this to an
+    empty bucket.
+
+    This class will create a table called "gcra" in the database to store
+    state. The "key" attribute gets used as the primary key within the table.
+
+    Attributes:
+        path: The path to the sqlite database.
+        key: A unique key for this bucket within the database.
+        rate: The maximum number of tokens.
+        period: The time for the bucket to reach the maximum number of tokens.
+            The bucket refills at a rate of `rate / period`.
+        usage: A UsageLog to record consumption to, or None.
+    """
+
+    _AVAILABLE_SQL = (
+        "max(0.0, min(:rate, :rate - (tat - :now) * :rate / :period))")
+    _CONSUME_SQL = (
+        "insert into gcra (key, tat) "
+        "select :key, :now + :n * :period / :rate "
+        "where :rate >= :n and :rate > :leave "
+        "on conflict (key) do update set "
+        "  tat = max(tat, :now) + :n * :period / :rate "
+        "where {available} >= :n and {available} > :leave "
+        "returning :rate - (tat - :now) * :rate / :period, :now").format(
+            available=_AVAILABLE_SQL)
+
+    _SCHEMA = (
+        ("gcra",
+         "create table if not exists gcra ("
+         "  key text primary key,"
+         "  tat float not null)"),
+    )
+
+    def _load(self, cursor):
+        rows = cursor.execute(
+            "select tat from gcra where key = ?", (self.key,)).fetchall()
+        if not rows:
+            return None
+        # The bucket was empty one period before it will be full.
+        return (0.0, rows[0][0] - self.period)
+
+    def _write(self, cursor, tokens, timestamp):
+        cursor.execute(
+            "insert or replace into gcra (key, tat) values (?, ?)",
+            (self.key, timestamp + (self.rate - tokens) * self.period /
+             self.rate))
+
+    def _recover(self, cursor, query_time):
+        cursor.execute(
+            "update gcra set tat = ? where key = ? and tat > ?",
+            (query_time + self.period, self.key,
+             query_time + self.period + CLOCK_TOLERANCE))
+
+
+class SlidingWindowTokenBucket(TokenBucket):
+    """
+    A token bucket which approximates a sliding window with two counters.
+
+    Time is split into fixed windows of length `period`, aligned to multiples
+    of `period`. We count the tokens consumed in the current window and in the
+    previous one. The tokens consumed in the sliding window of length `period`
+    ending now are estimated by assuming the previous window's tokens were
+    spread evenly over it:
+
+        used = previous * (1 - elapsed / period) + current
+
+    and `rate - used` tokens are available.
+
+    This stores a constant amount of state per key, unlike
+    TimeSeriesTokenBucket, whose state grows with `rate`. The approximation
+    has these error bounds relative to TimeSeriesTokenBucket:
+
+    - It may give out more tokens than the exact window allows, when the
+      previous window's tokens were late in that window. It never gives out
+      more than `2 * rate` tokens in any window of length `period`.
+    - It may refuse tokens the exact window would allow, when the previous
+      window's tokens were early in that window. The previous window's
+      count keeps decaying until the end of the next fixed window, so it
+      never refuses tokens once `period` has passed since the end of the
+      fixed window of the last consume. That's at most `2 * period` after
+      the last consume.
+
+    For evenly-spread traffic, the estimate is exact.
+
+    The state of the bucket is represented as a (tokens, timestamp) tuple.
+    This state gets returned from most functions.
+
+    This class will create a table called "sliding_window" in the database to
+    store state. The "key" attribute gets used as the primary key within the
+    table. It stores one row per bucket.
+
+    Attributes:
+        path: The path to the sqlite database.
+        key: A unique key for this bucket within the database.
+        rate: The number of tokens allowed in any window of length `period`.
+        period: The length of the window.
+        usage: A UsageLog to record consumption to, or None.
+    """
+
+    _CONSUME_SQL = None
+
+    _SCHEMA = (
+        ("sliding_window",
+         "create table if not exists sliding_window ("
+         "  key text primary key,"
+         "  start float not null,"
+         "  previous float not null,"
+         "  current float not null)"),
+    )
+
+    def _get_window(self, cursor, query_time):
+        """Reads the window counters, and rolls them forward to a query time.
+
+        This function doesn't write to the database.
+
+        Args:
+            cursor: The cursor to use.
+            query_time: The query time.
+
+        Returns:
+            A (start, previous, current) tuple for the window containing
+                `query_time`.
+        """
+        start = query_time - (query_time % self.period)
+        rows = cursor.execute(
+            "select start, previous, current from sliding_window "
+            "where key = ?", (self.key,)).fetchall()
+        if not rows:
+            return (start, 0.0, 0.0)
+        return self._roll(rows[0], start)
+
+    def _roll(self, window, start):
+        """Rolls window counters forward to a window starting at `start`.
+
+        This function doesn't touch the database, and has no side effects.
+        """
+        old_start, previous, current = window
+        if start <= old_start:
+            return (old_start, previous, current)
+        if start - old_start < 1.5 * self.period:
+            return (start, current, 0.0)
+        return (start, 0.0, 0.0)
+
+    def _used(self, window, query_time):
+        """Estimates the tokens used in the sliding window ending now."""
+        start, previous, current = window
+        elapsed = min(1.0, max(0.0, (query_time - start) / self.period))
+        return previous * (1.0 - elapsed) + current
+
+    def _put_window(self, cursor, window):
+        cursor.execute(
+            "insert or replace into sliding_window "
+            "(key, start, previous, current) values (?, ?, ?, ?)",
+            (self.key,) + tuple(window))
+
+    def _when(self, window, used, query_time):
+        """Get the earliest time at which at most `used` tokens are used.
+
+        This function doesn't touch the database, and has no side effects.
+
+        Args:
+            window: A (start, previous, current) tuple.
+            used: The target number of tokens used.
+            query_time: The earliest time to return.
+
+        Returns:
+            A timestamp.
+        """
+        start, previous, current = window
+        if self._used(window, query_time) <= used:
+            return query_time
+        if current <= used:
+            return start + (1.0 - (used - current) / previous) * self.period
+        # In the next window, `current` becomes `previous`.
+        return start + (2.0 - used / current) * self.period
+
+    def _read(self, cursor, query_time):
+        window = self._get_window(cursor, query_time)
+        tokens = self._clamp(self.rate - self._used(window, query_time))
+        return (tokens, query_time)
+
+    def _write(self, cursor, tokens, timestamp):
+        # Reach the given number of tokens by adjusting the current counter.
+        # If that's not enough, the previous counter gets reduced too.
+        window = self._get_window(cursor, timestamp)
+        start, previous, _ = window
+        decayed = self._used((start, previous, 0.0), timestamp)
+        current = self.rate - tokens - decayed
+        if current < 0:
+            if decayed > 0:
+                previous *= (self.rate - tokens) / decayed
+            current = 0.0
+        self._put_window(cursor, (start, previous, current))
+
+    def _try_consume_many(self, requests):
+        results = []
+        with self._begin() as cursor:
+            query_time = time.time()
+            start, previous, current = self._get_window(cursor, query_time)
+            for n, leave in requests:
+                tokens = self._clamp(self.rate - self._used(
+                    (start, previous, current), query_time))
+                success = tokens >= n and tokens > leave
+                if success:
+                    current += n
+                    tokens -= n
+                    log().debug(
+                        "%s: Gave %s token(s). %s remaining.",
+                        self.key, n, tokens)
+                results.append((success, tokens, query_time))
+            self._put_window(cursor, (start, previous, current))
+        return results
+
+    def _try_consume(self, n, leave):
+        assert n > 0, n
+        assert n <= self.rate, n
+        return super(SlidingWindowTokenBucket, self)._try_consume(n, leave)
+
+    def _estimate(self, tokens, timestamp, n, query_time):
+        """Estimate the timestamp at which we would have a number of tokens.
+
+        Unlike other buckets, this needs more state than (tokens, timestamp),
+        so it reads the window counters from the database again.
+        """
+        assert n <= self.rate, n
+        window = self._get_window(self._cursor, query_time)
+        return self._when(window, self.rate - n, query_time)
+
+    def availability_schedule(self, n_total, horizon, leave=None):
+        """Estimate when each of a number of tokens will become available.
+
+        As for TokenBucket.availability_schedule(). This performs a single
+        read of the window counters, and doesn't write.
+        """
+        if leave is None:
+            leave = 0
+        query_time = time.time()
+        window = self._get_window(self._cursor, query_time)
+        return self._schedule_window(
+            window, query_time, n_total, query_time + horizon, leave)
+
+    def _schedule_window(self, window, query_time, n_total, end, leave):
+        """Estimate when each of a number of tokens would become available.
+
+        This function doesn't touch the database, and has no side effects.
+
+        Args:
+            window: A (start, previous, current) tuple as of `query_time`.
+            query_time: The time as of which the query is made.
+            n_total: The maximum number of tokens to schedule.
+            end: The latest timestamp to schedule.
+            leave: The number of tokens to leave over.
+
+        Returns:
+            An array.array("d") of non-decreasing timestamps.
+        """
+        schedule = array.array("d")
+        # As for try_consume(), we need tokens >= 1 and tokens > leave.
+        strict = leave >= 1
+        need = max(1.0, leave)
+        if need > self.rate or (strict and need >= self.rate):
+            return schedule
+        t = query_time
+        for _ in range(int(n_total)):
+            t = self._when(window, self.rate - need, t)
+            window = self._roll(window, t - (t % self.period))
+            start, previous, current = window
+            if (strict and previous == 0 and
+                    self._used(window, t) >= self.rate - need):
+                # Usage is flat until the window rolls, and only drops below
+                # the target after that.
+                t = start + self.period
+                start, previous, current = self._roll(window, t)
+            if t > end:
+                break
+            window = (start, previous, current + 1)
+            schedule.append(t)
+        return schedule
+
+    def _recover(self, cursor, query_time):
+        cursor.execute(
+            "update sliding_window set start = ? where key = ? and start > ?",
+            (query_time - (query_time % self.period), self.key,
+             query_time + CLOCK_TOLERANCE))
+
+
+class UsageLog(object):
+    """
+    An append-only log of bucket consumption, with downsampled rollups.
+
+    Buckets given a UsageLog record each try_consume() and consume() call to
+    it. Recording only appends to an in-memory list. A background thread
+    writes pending records to the database in batches, every `flush_interval`
+    seconds or whenever `batch_size` records are pending.
+
+    This class will create two tables in the database. "tbucket_usage" stores
+    one row per call: (key, time, n, granted, wait). Rows older than
+    `retention` are deleted as batches are written. "tbucket_usage_rollup"
+    stores one row per key per `resolution` seconds, with the number of calls,
+    tokens consumed, calls denied, and total time spent waiting. Rollups are
+    updated as each batch is written, and are never deleted.
+
+    A denied call is a try_consume() call which failed. consume() never fails;
+    the time it spends waiting is recorded as its wait time instead.
+
+    Pending records are lost if the process exits without calling close().
+    Records made after close() are dropped.
+
+    Attributes:
+        path: The path to the sqlite database.
+        flush_interval: The longest time, in seconds, to hold pending records.
+        batch_size: The number of pending records which triggers a write.
+        retention: The time, in seconds, to keep per-call rows. If None, they
+            are kept forever.
+        resolution: The time, in seconds, covered by each rollup row.
+    """
+
+    _SCHEMA = (
+        ("tbucket_usage",
+         "create table if not exists tbucket_usage ("
+         "  key text not null,"
+         "  time float not null,"
+         "  n float not null,"
+         "  granted boolean not null,"
+         "  wait float not null)"),
+        ("tbucket_usage_time",
+         "create index if not exists tbucket_usage_time "
+         "on tbucket_usage (time)"),
+        ("tbucket_usage_rollup",
+         "create table if not exists tbucket_usage_rollup ("
+         "  key text not null,"
+         "  time float not null,"
+         "  calls integer not null,"
+         "  consumed float not null,"
+         "  denied integer not null,"
+         "  wait float not null,"
+         "  primary key (key, time))"),
+    )
+
+    def __init__(self, path, flush_interval=1.0, batch_size=1000,
+                 retention=86400.0, resolution=60.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.retention = retention
+        self.resolution = float(resolution)
+
+        self._pending = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._thread = None
+        self._db = None
+
+    def record(self, key, n, granted, wait=0.0):
+        """Records one call to a bucket.
+
+        This only appends to an in-memory list, and never touches the
+        database. Records made after close() are dropped.
+
+        Args:
+            key: The bucket's key.
+            n: The number of tokens requested.
+            granted: Whether the tokens were given.
+            wait: The time spent waiting for the tokens.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._pending.append((key, time.time(), n, granted, wait))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+            if len(self._pending) >= self.batch_size:
+                self._wakeup.set()
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except:
+                log().exception("%s: Failed to write usage", self.path)
+
+    def _connect(self):
+        if self._db is None:
+            import apsw
+            db = apsw.Connection(self.path)
+            db.setbusytimeout(5000)
+            _ensure_schema(db, self._SCHEMA)
+            self._db = db
+        return self._db
+
+    def flush(self):
+        """Writes all pending records to the database.
+
+        Will perform a BEGIN IMMEDIATE transaction on the database, if any
+        records are pending.
+        """
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, []
+            if not pending:
+                return
+            rollups = {}
+            for key, t, n, granted, wait in pending:
+                bucket = (key, t - t % self.resolution)
+                calls, consumed, denied, total_wait = rollups.get(
+                    bucket, (0, 0.0, 0, 0.0))
+                rollups[bucket] = (
+                    calls + 1, consumed + (n if granted else 0),
+                    denied + (0 if granted else 1), total_wait + wait)
+            cursor = self._connect().cursor()
+            cursor.execute("begin immediate")
+            try:
+                cursor.executemany(
+                    "insert into tbucket_usage (key, time, n, granted, wait) "
+                    "values (?, ?, ?, ?, ?)", pending)
+                cursor.executemany(
+                    "insert or ignore into tbucket_usage_rollup "
+                    "(key, time, calls, consumed, denied, wait) "
+                    "values (?, ?, 0, 0, 0, 0)", list(rollups.keys()))
+                cursor.executemany(
+                    "update tbucket_usage_rollup set calls = calls + ?, "
+                    "consumed = consumed + ?, denied = denied + ?, "
+                    "wait = wait + ? where key = ? and time = ?",
+                    [v + k for k, v in rollups.items()])
+                if self.retention is not None:
+                    cursor.execute(
+                        "delete from tbucket_usage where time < ?",
+                        (time.time() - self.retention,))
+            except:
+                cursor.execute("rollback")
+                raise
+            else:
+                cursor.execute("commit")
+
+    def close(self):
+        """Stops the background thread, and writes all pending records.
+
+        The database connection is closed. Any later records are dropped.
+        """
+        with self._lock:
+            self._closed = True
+            thread = self._thread
+        self._wakeup.set()
+        if thread is not None:
+            thread.join()
+        self.flush()
+        with self._flush_lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def series(self, key, start=None, end=None):
+        """Gets the rolled-up usage of a bucket over time.
+
+        Pending records are not included. Call flush() first if needed.
+
+        Args:
+            key: The bucket's key.
+            start: The earliest time to include. If None, starts from the
+                earliest rollup.
+            end: The latest time to include. If None, ends at the latest
+                rollup.
+
+        Returns:
+            A list of (time, calls, consumed, denied, wait) tuples in time
+                order, one for each `resolution` interval with any calls.
+                `time` is the start of the interval.
+        """
+        if start is None:
+            start = float("-inf")
+        if end is None:
+            end = float("inf")
+        with self._flush_lock:
+            return self._connect().cursor().execute(
+                "select time, calls, consumed, denied, wait "
+                "from tbucket_usage_rollup "
+                "where key = ? and time >= ? and time <= ? order by time",
+                (key, start, end)).fetchall()
+
+
+def init_db(path):
+    """Creates the tables and indexes used by all bucket classes.
+
+    Buckets check for their schema when they first connect. If it's missing,
+    they create it in a write transaction. Calling this once at deployment
+    time means short-lived processes only ever need the read-only check.
+
+    Args:
+        path: The path to the sqlite database.
+    """
+    import apsw
+    db = apsw.Connection(path)
+    db.setbusytimeout(5000)
+    try:
+        _ensure_schema(
+            db, TokenBucket._SCHEMA + TimeSeriesTokenBucket._SCHEMA +
+            GCRATokenBucket._SCHEMA + SlidingWindowTokenBucket._SCHEMA +
+            UsageLog._SCHEMA)
+    finally:
+        db.close()
+
+
+def recover_db(path, query_time=None):
+    """Repairs the state of all buckets after the clock stepped backwards.
+
+    Run this at startup, before any buckets are used. It repairs all keys in
+    bulk, rather than waiting for each to be noticed.
+
+    Classic and scheduled bucket states with timestamps in the future are
+    moved to now, keeping their tokens. Time-series keys with timestamps in
+    the future have all their timestamps shifted back together, so the latest
+    is now. Negative token counts are reset to zero. Timestamps within
+    CLOCK_TOLERANCE of now are left alone.
+
+    GCRA and sliding window states are not repaired here, since repairing
+    them depends on each bucket's period. Their recover() methods repair
+    them.
+
+    Tables which don't exist are skipped. If none exist, nothing is written.
+    Otherwise this will perform a BEGIN IMMEDIATE transaction on the database.
+
+    Args:
+        path: The path to the sqlite database.
+        query_time: The current time. If None, defaults to now.
+
+    Returns:
+        The number of rows repaired.
+    """
+    import apsw
+    if query_time is None:
+        query_time = time.time()
+    db = apsw.Connection(path)
+    db.setbusytimeout(5000)
+    try:
+        cursor = db.cursor()
+        tables = set(r[0] for r in cursor.execute(
+            "select name from sqlite_master where type = 'table'").fetchall())
+        if not tables & set(("tbf", "ts_token_bucket")):
+            return 0
+        cursor.execute("begin immediate")
+        try:
+            before = db.totalchanges()
+            if "tbf" in tables:
+                cursor.execute(
+                    "update tbf set last = ? where last > ?",
+                    (query_time, query_time + CLOCK_TOLERANCE))
+                cursor.execute("update tbf set tokens = 0 where tokens < 0")
+            if "ts_token_bucket" in tables:
+                _recover_time_series(cursor, query_time)
+            changes = db.totalchanges() - before
+        except:
+            cursor.execute("rollback")
+            raise
+        else:
+            cursor.execute("commit")
+    finally:
+        db.close()
+    if changes:
+        log().warning("%s: Repaired %s rows", path, changes)
+    return changes
+
+
+def _expire_rows(db, table, condition, params, batch_size):
+    """Deletes matching rows from a table, in bounded batches.
+
+    Batches walk the table in rowid order, so the whole table is scanned once,
+    without needing an index on `condition`. Each batch reads the next
+    `batch_size` rows outside any transaction, then deletes the matching ones
+    in a separate BEGIN IMMEDIATE transaction, re-checking `condition`. So
+    both the scan and the write lock are bounded by `batch_size` rows, even
+    when few rows match.
+
+    Args:
+        db: An apsw.Connection.
+        table: The table name.
+        condition: A SQL expression selecting rows to delete.
+        params: The bindings for `condition`.
+        batch_size: The most rows to scan and delete in one batch.
+
+    Returns:
+        The number of rows deleted.
+    """
+    cursor = db.cursor()
+    deleted = 0
+    last_rowid = float("-inf")
+    while True:
+        rows = cursor.execute(
+            "select rowid, (%s) from %s where rowid > ? "
+            "order by rowid limit ?" % (condition, table),
+            tuple(params) + (last_rowid, batch_size)).fetchall()
+        rowids = [rowid for rowid, matched in rows if matched]
+        if rowids:
+            before = db.totalchanges()
+            cursor.execute("begin immediate")
+            try:
+                cursor.executemany(
+                    "delete from %s where rowid = ? and (%s)" % (
+                        table, condition),
+                    [(rowid,) + tuple(params) for rowid in rowids])
+            except:
+                cursor.execute("rollback")
+                raise
+            else:
+                cursor.execute("commit")
+            deleted += db.totalchanges() - before
+        if len(rows) < batch_size:
+            return deleted
+        last_rowid = rows[-1][0]
+
+
+def expire_idle(path, max_idle, batch_size=1000, query_time=None):
+    """Deletes the state of idle buckets.
+
+    A bucket with no stored state behaves as a full bucket, so state can be
+    deleted once it's equivalent to that:
+
+    - Classic and scheduled buckets untouched for `max_idle`.
+    - Time-series token timestamps older than `max_idle`. Keys with no
+      timestamps left take no space.
+    - GCRA buckets which are full.
+    - Sliding window counters whose window started over `2 * max_idle` ago.
+
+    `max_idle` must be at least the longest `period` of any bucket in the
+    database. Otherwise some recently-used buckets would be refilled early.
+
+    Rows are scanned and deleted in batches of `batch_size`, each deleting
+    in its own BEGIN IMMEDIATE transaction. Tables which don't exist are
+    skipped.
+
+    Args:
+        path: The path to the sqlite database.
+        max_idle: The idle time after which state is deleted.
+        batch_size: The most rows to scan and delete in one batch.
+        query_time: The current time. If None, defaults to now.
+
+    Returns:
+        The number of rows deleted.
+    """
+    import apsw
+    if query_time is None:
+        query_time = time.time()
+    expiries = (
+        ("tbf", "last < ?", (query_time - max_idle,)),
+        ("ts_token_bucket", "time < ?", (query_time - max_idle,)),
+        ("gcra", "tat <= ?", (query_time,)),
+        ("sliding_window", "start < ?", (query_time - 2 * max_idle,)),
+    )
+    db = apsw.Connection(path)
+    db.setbusytimeout(5000)
+    try:
+        tables = set(r[0] for r in db.cursor().execute(
+            "select name from sqlite_master where type = 'table'").fetchall())
+        deleted = 0
+        for table, condition, params in expiries:
+            if table in tables:
+                deleted += _expire_rows(
+                    db, table, condition, params, batch_size)
+    finally:
+        db.close()
+    log().debug("%s: Expired %s rows", path, deleted)
+    return deleted
+
+
+def vacuum(path, pages=None, convert=False):
+    """Returns free pages in the database file to the filesystem.
+
+    New databases are created with incremental auto-vacuum, so this runs an
+    incremental vacuum, which only holds the write lock briefly per call. For
+    a database created some other way, this does nothing unless `convert` is
+    true.
+
+    With `convert`, such a database is switched to incremental auto-vacuum
+    with a full VACUUM. This is a one-off cost: it rewrites the whole file,
+    holding the write lock throughout, and needs as much free disk space as
+    the file again.
+
+    Args:
+        path: The path to the sqlite database.
+        pages: The most pages to free. If None, frees all free pages.
+        convert: Whether to convert a database without incremental
+            auto-vacuum.
+
+    Returns:
+        Whether the database uses incremental auto-vacuum.
+    """
+    import apsw
+    db = apsw.Connection(path)
+    db.setbusytimeout(5000)
+    try:
+        cursor = db.cursor()
+        # 2 is "incremental".
+        if cursor.execute("pragma auto_vacuum").fetchall()[0][0] != 2:
+            if not convert:
+                return False
+            log().warning("%s: Converting to incremental vacuum", path)
+            cursor.execute("pragma auto_vacuum = incremental")
+            cursor.execute("vacuum")
+            return True
+        if pages is None:
+            cursor.execute("pragma incremental_vacuum").fetchall()
+        else:
+            cursor.execute(
+                "pragma incremental_vacuum(%d)" % pages).fetchall()
+        return True
+    finally:
+        db.close()
+
+
+def maintain(path, max_idle, batch_size=1000, vacuum_pages=None,
+             convert_vacuum=False):
+    """Runs all periodic maintenance on a database.
+
+    This expires idle buckets with `expire_idle()`, then runs `vacuum()`.
+    Run it periodically, for example daily, to keep the file size and lookup
+    latency steady when keys come and go.
+
+    Databases created before incremental auto-vacuum was enabled never
+    shrink. A warning is logged for them, unless `convert_vacuum` is given to
+    convert them once.
+
+    Args:
+        path: The path to the sqlite database.
+        max_idle: As for expire_idle().
+        batch_size: As for expire_idle().
+        vacuum_pages: As for vacuum()'s `pages`.
+        convert_vacuum: As for vacuum()'s `convert`.
+
+    Returns:
+        The number of rows deleted.
+    """
+    deleted = expire_idle(path, max_idle, batch_size=batch_size)
+    if not vacuum(path, pages=vacuum_pages, convert=convert_vacuum):
+        log().warning(
+            "%s: Not using incremental vacuum, so free space isn't "
+            "returned. Pass convert_vacuum=True to convert it.", path)
+    return deleted
+
+
+def rate_limited_map(bucket, func, iterable, max_workers=8, batch_size=1,
+                     is_rate_limited=None, max_retries=3):
+    """Calls a function on each item of an iterable, limited by a bucket.
+
+    Each call consumes one token from `bucket`. Calls run on a thread pool, so
+    several may be in progress at once. A dispatcher thread reserves tokens
+    ahead of the consumer of the results, so throughput stays at the bucket's
+    limit rather than waiting on each call.
+
+    Tokens are only reserved for calls which can start right away, so no
+    more than `max_workers` calls are ever in progress, and each call starts
+    promptly after its token is consumed.
+
+    If a call fails because the remote side says we're over its limit, pass
+    `is_rate_limited` to recognize the error. The bucket will be emptied with
+    `bucket.set(0)`, and the call retried once another token is available.
+
+    Results are yielded in the same order as `iterable`. If a call raises an
+    exception (other than a retried one), it's re-raised when its result is
+    reached, and no new calls are started. Waits for tokens are interrupted
+    when the generator is closed, so closing it early returns promptly, once
+    calls already in progress finish.
+
+    Args:
+        bucket: Any bucket, such as a TokenBucket or TimeSeriesTokenBucket.
+        func: A function of one argument.
+        iterable: The items to call `func` on.
+        max_workers: The most calls to run at once.
+        batch_size: Reserve up to this many tokens at once. It's limited to
+            the bucket's rate and to `max_workers`.
+        is_rate_limited: A function which takes an exception raised by `func`
+            and returns whether it means we're over a remote rate limit. If
+            None, calls are never retried.
+        max_retries: The most times to retry a single call.
+
+    Yields:
+        The result of `func` for each item.
+    """
+    from concurrent import futures
+    try:
+        import queue
+    except ImportError:
+        import Queue as queue
+
+    batch_size = max(
+        1, min(int(batch_size), int(bucket.rate), int(max_workers)))
+    slots = threading.Semaphore(max_workers)
+    results = queue.Queue(max_workers * 2)
+    stop = threading.Event()
+
+    def reserve(n):
+        return bucket.consume(n, stop=stop) is not None
+
+    def call(item):
+        try:
+            for attempt in itertools.count():
+                try:
+                    return func(item)
+                except Exception as e:
+                    if (is_rate_limited is None or attempt >= max_retries or
+                            not is_rate_limited(e)):
+                        raise
+                    log().debug(
+                        "%s: Rate limited, retrying: %r", bucket.key, e)
+                    bucket.set(0)
+                    if not reserve(1):
+                        raise
+        finally:
+            slots.release()
+
+    def dispatch():
+        try:
+            items = iter(iterable)
+            while not stop.is_set():
+                chunk = list(itertools.islice(items, batch_size))
+                if not chunk:
+                    break
+                for _ in chunk:
+                    slots.acquire()
+                if stop.is_set() or not reserve(len(chunk)):
+                    for _ in chunk:
+                        slots.release()
+                    break
+                for item in chunk:
+                    results.put(("result", executor.submit(call, item)))
+        except Exception as e:
+            results.put(("error", e))
+        finally:
+            results.put(("done", None))
+
+    executor = futures.ThreadPoolExecutor(max_workers)
+    dispatcher = threading.Thread(target=dispatch)
+    dispatcher.daemon = True
+    dispatcher.start()
+    kind = None
+    try:
+        while True:
+            kind, value = results.get()
+            if kind == "done":
+                return
+            if kind == "error":
+                raise value
+            yield value.result()
+    finally:
+        stop.set()
+        # Unblock the dispatcher, so it can notice we stopped.
+        while kind != "done":
+            kind, _ = results.get()
+        dispatcher.join()
+        executor.shutdown()
+
+
+_SHM_MAGIC = b"tbucket1"
+# The file header: magic, number of slots. Padded to _SHM_HEADER_SIZE.
+_SHM_HEADER = struct.Struct("<8sI")
+_SHM_HEADER_SIZE = 64
+# Each slot: state, key length, tokens, timestamp. Followed by the key.
+_SHM_SLOT = struct.Struct("<BxH4xdd")
+_SHM_KEY_SIZE = 96
+_SHM_SLOT_SIZE = _SHM_SLOT.size + _SHM_KEY_SIZE
+_SHM_TOKENS = struct.Struct("<dd")
+_SHM_STATE = struct.Struct("<B")
+
+# Slot states.
+_SHM_EMPTY = 0
+_SHM_CLAIMED = 1
+_SHM_SET = 2
+
+
+class _SharedMemoryTable(object):
+    """A table of (tokens, timestamp) bucket states in a memory-mapped file.
+
+    The file is a fixed-size, open-addressed hash table of slots. Each key is
+    hashed to a starting slot and probed linearly. Slots are never freed, so
+    a key's slot never moves once claimed.
+
+    Each slot is guarded by a POSIX byte-range lock against other processes,
+    and by a threading.Lock against other threads in this process.
+
+    Use open() rather than the constructor, so each file is only mapped once
+    per process.
+
+    Attributes:
+        path: The real path to the file.
+        slots: The number of slots in the table.
+    """
+
+    _tables = {}
+    _tables_lock = threading.Lock()
+
+    @classmethod
+    def open(cls, path, slots):
+        """Gets the table for a file, creating the file if necessary.
+
+        Args:
+            path: The path to the file.
+            slots: The number of slots to use if the file is created. If
+                None, the file must already exist.
+
+        Returns:
+            A _SharedMemoryTable.
+        """
+        path = os.path.realpath(path)
+        with cls._tables_lock:
+            table = cls._tables.get(path)
+            if table is None:
+                table = cls._tables[path] = cls(path, slots)
+            return table
+
+    def __init__(self, path, slots):
+        if fcntl is None:
+            raise NotImplementedError(
+                "shared memory buckets require POSIX file locking")
+        import mmap
+        self.path = path
+        flags = os.O_RDWR if slots is None else os.O_RDWR | os.O_CREAT
+        self._fd = os.open(path, flags, 0o644)
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, _SHM_HEADER_SIZE, 0)
+        try:
+            if os.fstat(self._fd).st_size == 0:
+                os.ftruncate(
+                    self._fd, _SHM_HEADER_SIZE + slots * _SHM_SLOT_SIZE)
+                self._map = mmap.mmap(self._fd, 0)
+                _SHM_HEADER.pack_into(self._map, 0, _SHM_MAGIC, slots)
+            else:
+                self._map = mmap.mmap(self._fd, 0)
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, _SHM_HEADER_SIZE, 0)
+        magic, self.slots = _SHM_HEADER.unpack_from(self._map, 0)
+        if magic != _SHM_MAGIC or len(self._map) != (
+                _SHM_HEADER_SIZE + self.slots * _SHM_SLOT_SIZE):
+            raise ValueError("%s is not a tbucket shared memory file" % path)
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+
+    def _offset(self, index):
+        return _SHM_HEADER_SIZE + index * _SHM_SLOT_SIZE
+
+    def _thread_lock(self, index):
+        lock = self._locks.get(index)
+        if lock is None:
+            with self._locks_lock:
+                lock = self._locks.setdefault(index, threading.Lock())
+        return lock
+
+    @contextlib.contextmanager
+    def lock(self, index):
+        """Returns a context manager which exclusively locks a slot."""
+        offset = self._offset(index)
+        with self._thread_lock(index):
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, _SHM_SLOT_SIZE, offset)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, _SHM_SLOT_SIZE, offset)
+
+    def find(self, key):
+        """Finds the slot for a key, claiming an empty one if necessary.
+
+        Args:
+            key: A key, as a string or bytes.
+
+        Returns:
+            The index of the key's slot.
+        """
+        data = key if isinstance(key, bytes) else key.encode("utf-8")
+        if len(data) > _SHM_KEY_SIZE:
+            raise ValueError(
+                "key is longer than %d bytes: %r" % (_SHM_KEY_SIZE, key))
+        start = zlib.crc32(data) % self.slots
+        for i in range(self.slots):
+            index = (start + i) % self.slots
+            offset = self._offset(index)
+            with self.lock(index):
+                state, length, _, _ = _SHM_SLOT.unpack_from(self._map, offset)
+                if state == _SHM_EMPTY:
+                    _SHM_SLOT.pack_into(
+                        self._map, offset, _SHM_CLAIMED, len(data), 0.0, 0.0)
+                    key_offset = offset + _SHM_SLOT.size
+                    self._map[key_offset:key_offset + len(data)] = data
+                    return index
+                key_offset = offset + _SHM_SLOT.size
+                if (length == len(data) and
+                        self._map[key_offset:key_offset + length] == data):
+                    return index
+        raise RuntimeError("%s is full" % self.path)
+
+    def read(self, index):
+        """Reads a slot's state. The slot should be locked.
+
+        Returns:
+            A (tokens, timestamp) tuple, or None if the state was never set.
+        """
+        offset = self._offset(index)
+        if _SHM_STATE.unpack_from(self._map, offset)[0] != _SHM_SET:
+            return None
+        return _SHM_TOKENS.unpack_from(self._map, offset + 8)
+
+    def write(self, index, tokens, timestamp):
+        """Writes a slot's state. The slot should be locked."""
+        offset = self._offset(index)
+        _SHM_TOKENS.pack_into(self._map, offset + 8, tokens, timestamp)
+        _SHM_STATE.pack_into(self._map, offset, _SHM_SET)
+
+    def items(self):
+        """Yields (key, tokens, timestamp) for all slots with a set state.
+
+        Each slot is locked while it is read.
+        """
+        for index in range(self.slots):
+            offset = self._offset(index)
+            with self.lock(index):
+                state, length, tokens, timestamp = _SHM_SLOT.unpack_from(
+                    self._map, offset)
+                key_offset = offset + _SHM_SLOT.size
+                key = self._map[key_offset:key_offset + length]
+            if state == _SHM_SET:
+                yield (key.decode("utf-8"), tokens, timestamp)
+
+
+class SharedMemoryTokenBucket(TokenBucket):
+    """
+    A classic token bucket which keeps its state in a memory-mapped file.
+
+    This has the same semantics as TokenBucket, including across processes,
+    but avoids SQLite's locking and journaling. It's intended for many
+    processes on a single host.
+
+    The file holds a fixed-size table of (tokens, timestamp) states, one slot
+    per key. Each state update holds a POSIX lock on the key's slot. The file
+    is created with `slots` slots if it doesn't exist. Keys must be at most 96
+    bytes when encoded as UTF-8, and a full table can't accept new keys.
+
+    State in the file is not synced to disk. Use `snapshot_shared_memory()`
+    to copy it into a SQLite database.
+
+    Attributes:
+        path: The path to the memory-mapped file.
+        key: A unique key for this bucket within the file.
+        rate: The maximum number of tokens.
+        period: The time for the bucket to reach the maximum number of tokens.
+            The bucket refills at a rate of `rate / period`.
+    """
+
+    _CONSUME_SQL = None
+
+    def __init__(self, path, key, rate, period, slots=4096, combine=False,
+                 usage=None):
+        super(SharedMemoryTokenBucket, self).__init__(
+            path, key, rate, period, combine=combine, usage=usage)
+        self._table = _SharedMemoryTable.open(path, slots)
+        self._index = self._table.find(key)
+
+    @property
+    def db(self):
+        """Not supported. Shared memory buckets don't use a database."""
+        raise AttributeError("shared memory buckets have no database")
+
+    @contextlib.contextmanager
+    def _begin(self):
+        """Returns a context manager which locks our slot."""
+        with self._table.lock(self._index):
+            yield None
+
+    def _load(self, cursor):
+        return self._table.read(self._index)
+
+    def _write(self, cursor, tokens, timestamp):
+        self._table.write(self._index, tokens, timestamp)
+
+    def _set(self, tokens, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        tokens = self._clamp(tokens)
+        self._write(None, tokens, timestamp)
+        return (tokens, timestamp)
+
+    def _peek(self):
+        tokens, timestamp = self._read(None, time.time())
+        self._write(None, tokens, timestamp)
+        return (tokens, timestamp)
+
+    def _read_state(self, query_time):
+        with self._begin():
+            return self._read(None, query_time)
+
+    def _recover(self, cursor, query_time):
+        state = self._load(None)
+        if state is not None and state[1] > query_time + CLOCK_TOLERANCE:
+            self._write(None, state[0], query_time)
+
+
+class SharedMemoryScheduledTokenBucket(
+        SharedMemoryTokenBucket, ScheduledTokenBucket):
+    """
+    A scheduled token bucket which keeps its state in a memory-mapped file.
+
+    This has the same semantics as ScheduledTokenBucket, with storage as in
+    SharedMemoryTokenBucket.
+
+    Attributes:
+        path: The path to the memory-mapped file.
+        key: A unique key for this bucket within the file.
+        rate: The number of tokens the bucket will be reset to.
+        period: How often the bucket is reset.
+    """
+
+
+def snapshot_shared_memory(path, db_path):
+    """Copies the state of shared memory buckets into a SQLite database.
+
+    The states are written to the "tbf" table, as used by TokenBucket and
+    ScheduledTokenBucket, replacing any existing rows for the same keys.
+
+    Each key's slot is locked while it's read, so each state is consistent,
+    but the snapshot as a whole is not atomic.
+
+    Will perform a BEGIN IMMEDIATE transaction on the database.
+
+    Args:
+        path: The path to the memory-mapped file.
+        db_path: The path to the sqlite database.
+
+    Returns:
+        The number of keys copied.
+    """
+    import apsw
+    rows = list(_SharedMemoryTable.open(path, None).items())
+    db = apsw.Connection(db_path)
+    db.setbusytimeout(5000)
+    try:
+        cursor = db.cursor()
+        cursor.execute("begin immediate")
+        try:
+            cursor.execute(_TBF_SCHEMA_SQL)
+            cursor.executemany(
+                "insert or replace into tbf (key, tokens, last) "
+                "values (?, ?, ?)", rows)
+        except:
+            cursor.execute("rollback")
+            raise
+        else:
+            cursor.execute("commit")
+    finally:
+        db.close()
+    return len(rows)